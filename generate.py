@@ -1,4 +1,6 @@
+import heapq
 import sys
+from collections import Counter, defaultdict, deque
 
 from crossword import *
 
@@ -10,8 +12,32 @@ class CrosswordCreator():
         Create new CSP crossword generate.
         """
         self.crossword = crossword
+
+        # Group the vocabulary by word length so each domain starts with only words that fit
+        words_by_length = defaultdict(set)
+        for word in self.crossword.words:
+            words_by_length[len(word)].add(word)
+
         self.domains = {
-            var: self.crossword.words.copy()
+            var: set(words_by_length[var.length])
+            for var in self.crossword.variables
+        }
+
+        # Number of variables, to tell when an assignment is complete
+        self._n_vars = len(self.crossword.variables)
+
+        # Neighbors never change, so compute them once per variable
+        self._neighbors = {
+            var: frozenset(self.crossword.neighbors(var))
+            for var in self.crossword.variables
+        }
+
+        # Likewise, pair each neighbor with the overlap positions (i in var, j in neighbor)
+        self._overlap = {
+            var: [
+                (neighbor, *self.crossword.overlaps[var, neighbor])
+                for neighbor in self._neighbors[var]
+            ]
             for var in self.crossword.variables
         }
 
@@ -31,15 +57,25 @@ class CrosswordCreator():
                 letters[i][j] = word[k]
         return letters
 
+    def _letter_map(self, assignment):
+        """
+        Return a dict mapping each filled (i, j) cell to its letter.
+        """
+        return {
+            cell: letter
+            for variable, word in assignment.items()
+            for cell, letter in zip(variable.cells, word)
+        }
+
     def print(self, assignment):
         """
         Print crossword assignment to the terminal.
         """
-        letters = self.letter_grid(assignment)
+        letters = self._letter_map(assignment)
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
                 if self.crossword.structure[i][j]:
-                    print(letters[i][j] or " ", end="")
+                    print(letters.get((i, j)) or " ", end="")
                 else:
                     print("█", end="")
             print()
@@ -52,7 +88,7 @@ class CrosswordCreator():
         cell_size = 100
         cell_border = 2
         interior_size = cell_size - 2 * cell_border
-        letters = self.letter_grid(assignment)
+        letters = self._letter_map(assignment)
 
         # Create a blank canvas
         img = Image.new(
@@ -64,24 +100,51 @@ class CrosswordCreator():
         font = ImageFont.truetype("assets/fonts/OpenSans-Regular.ttf", 80)
         draw = ImageDraw.Draw(img)
 
+        # Letters are rendered once onto an opaque white cell interior and pasted
+        # (rectangle corners are inclusive, so the interior spans interior_size + 1 pixels).
+        # Pillow positions a glyph differently depending on the sign of its fractional
+        # coordinates, so each tile is drawn one cell in from its corner unless the cell
+        # is on the canvas's top row or left column, matching where the canvas would draw it.
+        glyph_size = interior_size + 1
+        glyphs = {}
+
+        def render_glyph(letter, pad_x, pad_y):
+            glyph = Image.new("RGBA", (pad_x + cell_size, pad_y + cell_size), "white")
+            glyph_draw = ImageDraw.Draw(glyph)
+            _, _, w, h = glyph_draw.textbbox((0, 0), letter, font=font)
+            glyph_draw.text(
+                (pad_x + cell_border + ((interior_size - w) / 2),
+                 pad_y + cell_border + ((interior_size - h) / 2) - 10),
+                letter, fill="black", font=font
+            )
+            return glyph.crop((
+                pad_x + cell_border, pad_y + cell_border,
+                pad_x + cell_border + glyph_size, pad_y + cell_border + glyph_size
+            ))
+
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
 
+                # Blocked cells are left as the black background
+                if not self.crossword.structure[i][j]:
+                    continue
+
                 rect = [
                     (j * cell_size + cell_border,
                      i * cell_size + cell_border),
                     ((j + 1) * cell_size - cell_border,
                      (i + 1) * cell_size - cell_border)
                 ]
-                if self.crossword.structure[i][j]:
-                    draw.rectangle(rect, fill="white")
-                    if letters[i][j]:
-                        _, _, w, h = draw.textbbox((0, 0), letters[i][j], font=font)
-                        draw.text(
-                            (rect[0][0] + ((interior_size - w) / 2),
-                             rect[0][1] + ((interior_size - h) / 2) - 10),
-                            letters[i][j], fill="black", font=font
+                letter = letters.get((i, j))
+                if letter:
+                    key = (letter, j > 0, i > 0)
+                    if key not in glyphs:
+                        glyphs[key] = render_glyph(
+                            letter, cell_size if j else 0, cell_size if i else 0
                         )
+                    img.paste(glyphs[key], rect[0])
+                else:
+                    draw.rectangle(rect, fill="white")
 
         img.save(filename)
 
@@ -101,14 +164,12 @@ class CrosswordCreator():
         """
         # For loop over the variables
         for variable in self.domains:
-            values_copy = set(self.domains[variable])
 
-            # Check the values and see if theyre node consistent(length of value = length of variable)
-            for value in values_copy:       
-                if len(value) != variable.length:
-
-                    # If a value is not node consistent. remove it
-                    self.domains[variable].remove(value)
+            # Keep only the values that are node consistent (length of value = length of variable)
+            self.domains[variable] = {
+                value for value in self.domains[variable]
+                if len(value) == variable.length
+            }
 
     def revise(self, x, y):
         """
@@ -122,28 +183,26 @@ class CrosswordCreator():
         # Get the overlap position
         overlap = self.crossword.overlaps[x , y]
 
-        # Create a new copy of X variable
-        X_copy = set(self.domains[x])
+        # Without an overlap there is nothing to revise
+        if overlap is None:
+            return False
 
-        # Inital revised is false
-        revised = False
+        # Compare the characters in X and Y values to see if theres a match
+        overlap_X_value, overlap_Y_value = overlap
 
-        # If there is an overlap, compare the characters in X and Y values to see if theres a match
-        if overlap is not None and len(overlap) == 2:
-            overlap_X_value, overlap_Y_value = overlap
+        # Collect the letters Y's domain can place at the overlap, once per call
+        y_letters = {valueY[overlap_Y_value] for valueY in self.domains[y]}
 
-            for valueX in X_copy:
-                # Flag indicating if there is a satisfying value in Y's domain
-                has_satisfying_value = any(valueY[overlap_Y_value] == valueX[overlap_X_value] for valueY in self.domains[y])
+        # Gather every X value with no match in one pass, then remove them together
+        unsupported = {
+            valueX for valueX in self.domains[x]
+            if valueX[overlap_X_value] not in y_letters
+        }
+        if not unsupported:
+            return False
 
-                # If there is no match, remove the X value
-                if not has_satisfying_value:
-                    self.domains[x].remove(valueX)
-                    revised = True
-        
-        # Return True or False
-        return revised
-        
+        self.domains[x] -= unsupported
+        return True
 
     def ac3(self, arcs=None):
         """
@@ -157,28 +216,44 @@ class CrosswordCreator():
 
         # If arcs is none, begin with initial list of all arcs
         if arcs is None:
-            arcs = []
 
-            # get all the arcs in the crossword (all overlaps)
-            for value in self.crossword.overlaps:
-                if self.crossword.overlaps[value] is not None:
-                    arcs.append(value)
+            # get all the arcs in the crossword (every variable with each of its neighbors)
+            arcs = [
+                (x, y) for x in self._neighbors
+                for y in self._neighbors[x]
+            ]
 
-        # While the queue is not None:
-        while arcs:
+        # Queue of arcs, plus the set of arcs currently waiting in it
+        queue = deque()
+        pending = set()
+        for arc in arcs:
+            if arc not in pending:
+                queue.append(arc)
+                pending.add(arc)
+
+        # Bind the methods used on every iteration once, outside the loop
+        revise = self.revise
+        neighbors = self._neighbors
+        domains = self.domains
+
+        # While the queue is not empty:
+        while queue:
 
             # Take a single arc from the queue (2 variables X, Y)
-            x, y = arcs.pop()
+            arc = queue.popleft()
+            pending.discard(arc)
+            x, y = arc
 
             # Call the revise function that makes X, Y arc consistent and return False if there are no values in X
-            if self.revise(x, y):
-                if  len(self.domains[x]) == 0:
+            if revise(x, y):
+                if  len(domains[x]) == 0:
                     return False
-                
+
                 # If change was made, then gather all other arcs, Z, connected to X (except Y) and enqueue them in the queue
-                for z in self.crossword.neighbors(x):
-                    if z != y:
-                        arcs.append((z, x))
+                for z in neighbors[x]:
+                    if z != y and (z, x) not in pending:
+                        queue.append((z, x))
+                        pending.add((z, x))
 
         return True
 
@@ -190,66 +265,75 @@ class CrosswordCreator():
         crossword variable); return False otherwise.
         """
 
-        return all(variable in assignment for variable in self.domains)
+        return len(assignment) == self._n_vars
 
     def consistent(self, assignment):
         """
         Return True if `assignment` is consistent (i.e., words fit in crossword
         puzzle without conflicting characters); return False otherwise.
         """
-        # Initialize is_consistent
-        is_consistent = True
-
         # Check values are distinct
-        for variable1 in assignment:
-            for variable2 in assignment:
-                if variable2 != variable1 and assignment[variable1] == assignment[variable2]:
-                    is_consistent = False
-                    break
-            if not is_consistent:
-                break
+        if len(set(assignment.values())) != len(assignment):
+            return False
 
         for variable in assignment:
 
             # Value is the correct length
             if variable.length != len(assignment[variable]):
-                is_consistent = False
-                break
+                return False
 
             # No conflict with neighbours
-            for neighbor in self.crossword.neighbors(variable):
+            for neighbor, i, j in self._overlap[variable]:
                 if neighbor in assignment:
-                    overlap = self.crossword.overlaps[variable, neighbor]
-                    if (overlap and assignment[variable][overlap[0]] != assignment[neighbor][overlap[1]]):
-                        is_consistent = False
-                        break
-
-        # Return is_consistent
-        return is_consistent
-    
-    def order_domain_values(self, var, assignment):
+                    if assignment[variable][i] != assignment[neighbor][j]:
+                        return False
+
+        return True
+
+    def _consistent_add(self, assignment, var):
         """
-        Return a list of values in the domain of `var`, in order by
-        the number of values they rule out for neighboring variables.
-        The first value in the list, for example, should be the one
-        that rules out the fewest values among the neighbors of `var`.
+        Return True if `assignment` is still consistent after `var` was
+        given its value, assuming it was consistent before. Only the
+        constraints involving `var` are checked; `backtrack` ensures the
+        value is not already used by another variable.
         """
+        word = assignment[var]
 
-        value_ruleout = {val: 0 for val in self.domains[var]}
+        # Value is the correct length
+        if var.length != len(word):
+            return False
 
-        # Iterate over domains and neighbors and increase value_ruleout for every value ruled out by a variable
-        for variable in self.domains[var]:
-            if variable not in assignment:
-                for neighbor in self.crossword.neighbors(var):
-                    if neighbor not in assignment:
-                        overlap = self.crossword.overlaps[var, neighbor]
-                        x, y = overlap
-                        for neighbor_value in self.domains[neighbor]:
-                            if overlap and variable[x] != neighbor_value[y]:
-                                value_ruleout[variable] += 1
+        # No conflict with assigned neighbours
+        for neighbor, i, j in self._overlap[var]:
+            if neighbor in assignment and word[i] != assignment[neighbor][j]:
+                return False
+
+        return True
+
+    def order_domain_values(self, var, assignment):
+        """
+        Return an iterator over the values in the domain of `var`, in order
+        by the number of values they rule out for neighboring variables.
+        The first value, for example, should be the one that rules out
+        the fewest values among the neighbors of `var`.
+        """
 
-        # Return list of vals sorted from fewest to most other_vals ruled out:
-        return sorted(value_ruleout.keys(), key = lambda x: value_ruleout[x])
+        # For every unassigned neighbor, count how often each letter appears at its overlap position
+        letter_counts = []
+        for neighbor, x, y in self._overlap[var]:
+            if neighbor not in assignment:
+                counts = Counter(neighbor_value[y] for neighbor_value in self.domains[neighbor])
+                letter_counts.append((x, len(self.domains[neighbor]), counts))
+
+        # A value rules out every neighbor value that has a different letter at the overlap
+        value_ruleout = [
+            (sum(size - counts[val[x]] for x, size, counts in letter_counts), val)
+            for val in self.domains[var]
+        ]
+
+        # Yield vals from fewest to most other_vals ruled out, only popping as many as backtrack tries
+        heapq.heapify(value_ruleout)
+        return (heapq.heappop(value_ruleout)[1] for _ in range(len(value_ruleout)))
 
 
     def select_unassigned_variable(self, assignment):
@@ -261,25 +345,34 @@ class CrosswordCreator():
         return values.
         """
 
-        variable_value_length = {}
+        best = None
+        best_key = None
 
         # Iterate through the variables not present in assignment
         for variable in self.domains:
             if variable not in assignment:
+                domain_length = len(self.domains[variable])
+
+                # A single remaining value cannot be beaten, so stop looking
+                if domain_length == 1:
+                    return variable
 
-                # Create tuple with domain lengths and degrees. Add to dictionary.
-                variable_value_length[variable] = (len(self.domains[variable]), -len(self.crossword.neighbors(variable)))
-        
-        # Return the minimum value, checking domain lengths first, then degrees second, if necessary.
-        return min(variable_value_length , key= lambda var: variable_value_length[var])
-            
+                # Compare domain lengths first, then degrees second, if necessary.
+                key = (domain_length, -len(self._neighbors[variable]))
+                if best_key is None or key < best_key:
+                    best = variable
+                    best_key = key
 
-    def backtrack(self, assignment):
+        return best
+
+    def backtrack(self, assignment, used=None):
         """
         Using Backtracking Search, take as input a partial assignment for the
         crossword and return a complete assignment if possible to do so.
 
         `assignment` is a mapping from variables (keys) to words (values).
+        `used` is the set of words in `assignment`, kept up to date across
+        recursive calls.
 
         If no assignment is possible, return None.
         """
@@ -287,15 +380,45 @@ class CrosswordCreator():
         if self.assignment_complete(assignment):
             return assignment
 
+        if used is None:
+            used = set(assignment.values())
+
         # Backtrack through each assignment
         var = self.select_unassigned_variable(assignment)
+
+        # Save the domains of unassigned variables so inferences can be undone
+        saved = {
+            variable: set(self.domains[variable])
+            for variable in self.domains if variable not in assignment
+        }
+
         for value in self.order_domain_values(var, assignment):
+
+            # Words must be distinct, so skip values already in use
+            if value in used:
+                continue
+
+            used.add(value)
             assignment[var] = value
-            if self.consistent(assignment):
-                result = self.backtrack(assignment)
-                if result:
-                    return result
+            if self._consistent_add(assignment, var):
+
+                # Maintain arc consistency: propagate the new value to unassigned neighbours
+                self.domains[var] = {value}
+                arcs = [
+                    (neighbor, var) for neighbor in self._neighbors[var]
+                    if neighbor not in assignment
+                ]
+                if self.ac3(arcs=arcs):
+                    result = self.backtrack(assignment, used)
+                    if result:
+                        return result
+
+                # Undo any inferences made for this value
+                self.domains.update(
+                    (variable, set(values)) for variable, values in saved.items()
+                )
             del assignment[var]
+            used.discard(value)
         return None
 
 def main():